@@ -2,35 +2,180 @@
 Data module for pretraining and classification task, require a dataset object as input
 '''
 
+import os
+import json
+import math
 import torch
+import numpy as np
+import torch.distributed as dist
 
 from typing import Optional
+from functools import partial
 from itertools import chain
 from argparse import ArgumentParser
 from transformers import AutoTokenizer, DataCollatorForLanguageModeling
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 from pytorch_lightning import LightningDataModule
 
 
+def tokenize(examples, tokenizer, text_col, max_length):
+    '''
+    Tokenize a batch of examples without padding. At module level so that `datasets` only
+    pickles the tokenizer into its workers and fingerprints the map the same way every time.
+    '''
+    return tokenizer(examples[text_col], truncation=True, max_length=max_length)
+
+
+class BucketSampler(Sampler):
+    '''
+    Batch sampler grouping examples of similar length to reduce padding.
+    Examples are sorted by length and chunked into batches, whose order is shuffled every epoch.
+    Under DDP every process takes its own share of the batches.
+    '''
+
+    def __init__(self, lengths, batch_size, shuffle=True, seed=0):
+        '''
+        :param lengths: number of tokens of each example
+        '''
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        if dist.is_available() and dist.is_initialized():
+            self.num_replicas, self.rank = dist.get_world_size(), dist.get_rank()
+        else:
+            self.num_replicas, self.rank = 1, 0
+
+    def __len__(self):
+        num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        if self.shuffle:
+            return num_batches // self.num_replicas
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        # Same seed on every process so that they agree on the batches
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+
+        lengths = torch.tensor(self.lengths)
+        if self.shuffle:
+            # Break ties randomly so that batches differ between epochs
+            indices = torch.randperm(len(lengths), generator=g)
+            indices = indices[torch.sort(lengths[indices], stable=True).indices]
+        else:
+            indices = torch.sort(lengths, stable=True).indices
+
+        batches = list(torch.split(indices, self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g)]
+            # Drop the remainder so that every process runs the same number of steps
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        elif batches:
+            # Pad by repeating the batches to keep every example, like `DistributedSampler`,
+            # so that every process gets `len(self)` batches even with fewer batches than processes
+            total = len(self) * self.num_replicas
+            batches = (batches * math.ceil(total / len(batches)))[:total]
+
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+
+class TeacherCache:
+    '''
+    Read-only view on the teacher features dumped by `BaseDistiller.precompute_teacher`
+    '''
+
+    # Sequence dims of each feature in (batch_size, num_layers, ...), so that features can be cut to the batch length
+    seq_dims = {
+        'attentions': (3, 4),
+        'values': (3,),
+        'hidden_states': (2,),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.features = None
+
+        manifest_file = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            raise ValueError(f"Teacher cache {path} has no manifest.json, delete it to compute it again")
+        with open(manifest_file) as f:
+            self.manifest = json.load(f)
+
+    def check(self, features=(), **expected):
+        '''
+        Raise if the cache was built for another setup, e.g. by another teacher
+
+        :param features: names of the features that must be cached
+        :param expected: other entries of the manifest and their expected values
+        '''
+        problems = [
+            f"{k} is {self.manifest.get(k)!r} instead of {v!r}"
+            for k, v in expected.items() if self.manifest.get(k) != v
+        ]
+        missing = set(features) - set(self.manifest['features'])
+        if missing:
+            problems.append(f"features {sorted(missing)} are missing")
+
+        if problems:
+            raise ValueError(f"Teacher cache {self.path} is stale: {'; '.join(problems)}. "
+                             f"Delete it to compute it again")
+
+    def get(self, indices, length):
+        '''
+        :param indices: list of example indices
+        :param length: sequence length of the batch
+        :return: dict of feature name to tensor of shape (len(indices), ...)
+        '''
+        # Opened lazily so that every dataloader worker maps the files itself
+        if self.features is None:
+            self.features = {
+                os.path.splitext(f)[0]: np.load(os.path.join(self.path, f), mmap_mode='r')
+                for f in os.listdir(self.path) if f.endswith('.npy')
+            }
+
+        # Read the rows in file order, then restore the batch order
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        inverse = np.argsort(order)
+
+        batch = {}
+        for name, feature in self.features.items():
+            index = [indices[order]] + [slice(None)] * (feature.ndim - 1)
+            for dim in self.seq_dims.get(name, ()):
+                index[dim] = slice(0, length)
+            batch[name] = torch.from_numpy(feature[tuple(index)][inverse])
+
+        return batch
+
+
 class ClfDataModule(LightningDataModule):
 
     @staticmethod
-    def collate_fn_def(batch):
+    def collate_fn_def(batch, pad_token_id=0, pad_to=None):
+        '''
+        :param pad_token_id: padding value of `input_ids`, other inputs are padded with 0
+        :param pad_to: fixed length to pad to, padded to the longest example by default
+        '''
 
-        keys = list(batch[0].keys())
-        keys.remove('text')
+        keys = [key for key in batch[0].keys() if key != 'text']
         if 'label' in keys:
             keys.remove('label')
             keys.append('labels')
 
         batch_dict = {key: [] for key in keys}
+        length = pad_to or max(len(item['input_ids']) for item in batch)
 
         for item in batch:
             for key in keys:
                 if key == 'labels':
                     batch_dict[key].append(torch.LongTensor([item['label']]))
                 else:
-                    batch_dict[key].append(torch.LongTensor(item[key]))
+                    pad = pad_token_id if key == 'input_ids' else 0
+                    batch_dict[key].append(torch.LongTensor(item[key] + [pad] * (length - len(item[key]))))
 
         batch_dict = {k: torch.stack(v, dim=0) for k, v in batch_dict.items()}
 
@@ -39,22 +184,42 @@ class ClfDataModule(LightningDataModule):
 
         return batch_dict
 
+    def collate_fn(self, batch, cache=None, pad_to=None):
+        '''
+        Collate a batch and attach the cached teacher features as `teacher_<name>`
+        '''
+        indices = [item.pop('example_idx') for item in batch] if 'example_idx' in batch[0] else None
+        batch_dict = self.collate_fn_def(batch, self.tokenizer.pad_token_id, pad_to)
+
+        if cache is not None:
+            length = batch_dict['input_ids'].size(1)
+            batch_dict.update({'teacher_' + k: v for k, v in cache.get(indices, length).items()})
+
+        return batch_dict
+
     def __init__(self, dataset, tokenizer,
                  max_length=128, batch_size=32,
-                 epochs=4, num_workers=0):
+                 epochs=4, num_workers=0, teacher_cache=None, num_proc=None):
         '''
         :param dataset:  A dataset object containing keys ['train', 'validation, 'test'],
                          see https://huggingface.co/docs/datasets/access.html
+        :param epochs: not used, the schedule follows the steps run by the trainer
+        :param teacher_cache: directory containing the teacher features of each split,
+                              see `BaseDistiller.precompute_teacher`
+        :param num_proc: number of processes for tokenization, all cpus shared among the DDP processes by default
         '''
         super(ClfDataModule, self).__init__()
 
         self.max_length = max_length
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.teacher_cache = teacher_cache
+        self.caches = {}
+        self.num_proc = num_proc
 
         self.dataset = dataset
-        self.num_training_steps = int(len(dataset['train']) / batch_size) * epochs
-        self.num_warmup_steps = int(0.1 * self.num_training_steps)
+        # Share of the training steps to warm up the learning rate
+        self.warmup_ratio = 0.1
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
 
     def setup(self, stage: Optional[str] = None) -> None:
@@ -65,51 +230,82 @@ class ClfDataModule(LightningDataModule):
         self.val = self.dataset['validation']
         self.test = self.dataset['test']
 
-        self.train = self.train.map(lambda e: self.tokenizer(e[self.text_col],
-                                                                 truncation=True,
-                                                                 padding='max_length',
-                                                                 max_length=self.max_length),
-                                                                 num_proc=1)
-        self.val = self.val.map(lambda e: self.tokenizer(e[self.text_col],
-                                                                 truncation=True,
-                                                                 padding='max_length',
-                                                                 max_length=self.max_length),
-                                                                 num_proc=1)
-        self.test = self.test.map(lambda e: self.tokenizer(e[self.text_col],
-                                                                 truncation=True,
-                                                                 padding='max_length',
-                                                                 max_length=self.max_length),
-                                                                 num_proc=1)
+        # Every DDP process tokenizes, so they share the cpus unless told otherwise
+        if dist.is_available() and dist.is_initialized():
+            world_size = dist.get_world_size()
+        else:
+            world_size = int(os.environ.get('WORLD_SIZE', 1))
+        num_proc = self.num_proc or max(1, os.cpu_count() // world_size)
+
+        # Tokenize once without padding, batches are padded to their longest example
+        tokenize_fn = partial(tokenize, tokenizer=self.tokenizer, text_col=self.text_col, max_length=self.max_length)
+        self.train = self.train.map(tokenize_fn, batched=True, num_proc=num_proc)
+        self.val = self.val.map(tokenize_fn, batched=True, num_proc=num_proc)
+        self.test = self.test.map(tokenize_fn, batched=True, num_proc=num_proc)
+
+        # Index the examples so that the collate function can look up the cached teacher features
+        self.caches = {}
+        for split in ['train', 'validation']:
+            if self.teacher_cache is None or not os.path.exists(os.path.join(self.teacher_cache, split)):
+                continue
+            cache = TeacherCache(os.path.join(self.teacher_cache, split))
+            cache.check(max_length=self.max_length, num_examples=len(self.train if split == 'train' else self.val))
+            self.caches[split] = cache
+            if split == 'train':
+                self.train = self.train.map(lambda e, i: {'example_idx': i}, with_indices=True)
+            else:
+                self.val = self.val.map(lambda e, i: {'example_idx': i}, with_indices=True)
+
+    def loader_kwargs(self):
+        '''
+        Pinned memory for asynchronous copies to the GPU, plus persistent workers prefetching
+        a few batches ahead when loading with worker processes
+        '''
+        kwargs = {'num_workers': self.num_workers, 'pin_memory': True}
+        if self.num_workers > 0:
+            kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+        return kwargs
+
+    def teacher_dataloader(self, split):
+        '''
+        A sequential dataloader without teacher features, used to precompute them.
+        Padded to `max_length` so that the cached features have a fixed shape.
+        '''
+        return DataLoader(
+            {'train': self.train, 'validation': self.val}[split],
+            batch_size=self.batch_size,
+            shuffle=False,
+            **self.loader_kwargs(),
+            collate_fn=partial(self.collate_fn, pad_to=self.max_length),
+        )
+
+    def bucket_sampler(self, dataset, shuffle):
+        return BucketSampler([len(ids) for ids in dataset['input_ids']], self.batch_size, shuffle=shuffle)
 
     def train_dataloader(self):
         self.train_loader = DataLoader(
             self.train,
-            batch_size=self.batch_size,
-            shuffle=True,
-            num_workers=self.num_workers,
-            pin_memory=True,
-            collate_fn=self.collate_fn_def,
+            batch_sampler=self.bucket_sampler(self.train, shuffle=True),
+            **self.loader_kwargs(),
+            collate_fn=partial(self.collate_fn, cache=self.caches.get('train')),
         )
         return self.train_loader
 
     def val_dataloader(self):
         self.valid_loader = DataLoader(
             self.val,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            pin_memory=True,
-            collate_fn=self.collate_fn_def,
+            batch_sampler=self.bucket_sampler(self.val, shuffle=False),
+            **self.loader_kwargs(),
+            collate_fn=partial(self.collate_fn, cache=self.caches.get('validation')),
         )
         return self.valid_loader
 
     def test_dataloader(self):
         self.test_loader = DataLoader(
             self.test,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            pin_memory=True,
-            collate_fn=self.collate_fn_def,
+            batch_sampler=self.bucket_sampler(self.test, shuffle=False),
+            **self.loader_kwargs(),
+            collate_fn=self.collate_fn,
         )
         return self.test_loader
\ No newline at end of file
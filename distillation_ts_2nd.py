@@ -6,19 +6,9 @@ from helper.distiller import *
 
 from datasets import load_dataset
 from pytorch_lightning import Trainer
-from utils import get_distillation_args
+from utils import get_distillation_args, get_model
 from pytorch_lightning.loggers import WandbLogger
 from pytorch_lightning.callbacks import LearningRateMonitor
-from transformers import AutoModelForSequenceClassification
-
-
-def get_model(name, num_labels):
-    model = AutoModelForSequenceClassification.from_pretrained(name, num_labels=num_labels)
-    model.config.output_attentions = True
-    model.config.output_hidden_states = True
-    model.config.output_values = True
-
-    return model
 
 
 if __name__ == '__main__':
@@ -33,20 +23,22 @@ if __name__ == '__main__':
 
     # Data Module
     dataset = load_dataset('tweet_eval', 'sentiment')
-    num_training_steps = int(len(dataset['train']) / args.batch_size) * args.epochs
-    num_warmup_steps = int(0.1 * num_training_steps)
 
     dm = ClfDataModule(
         dataset,
         tokenizer=teacher_model,
         max_length=args.max_length,
         batch_size=args.batch_size,
-        num_workers=args.num_workers
+        num_workers=args.num_workers,
+        teacher_cache=args.teacher_cache,
     )
 
     # Setup student and teacher
     teacher = get_model(teacher_model, 3)
     student = get_model(student_model, 3)
+    if args.grad_checkpointing:
+        # Trade compute for activation memory to fit larger batches
+        student.gradient_checkpointing_enable()
 
     distiller = BaseDistiller(
         teacher,
@@ -57,12 +49,28 @@ if __name__ == '__main__':
         learning_rate=args.learning_rate,
         weight_decay=args.weight_decay,
         eps=args.eps,
+        plot_attention=args.plot_attention,
+        plot_every=args.plot_every,
+        teacher_precision=args.teacher_precision,
+        compile_model=args.compile_model,
+        distill_mode=args.distill_mode,
+        optimizer=args.optimizer,
     )
 
+    # Run the teacher only once and reuse its features in every epoch
+    if args.teacher_cache:
+        distiller.build_teacher_cache(dm, args.teacher_cache)
+
     logger = WandbLogger(project=args.project, name=args.exp)
 
     trainer = Trainer(
-        gpus=1,
+        accelerator='gpu',
+        devices=args.devices,
+        # The heads get no gradient when only the inter layers are distilled
+        strategy='ddp' if distiller.distill_mode == 'inter' else 'ddp_find_unused_parameters_false',
+        precision=args.precision,
+        # `BucketSampler` shards the batches across processes itself
+        replace_sampler_ddp=False,
         logger=logger,
         max_epochs=args.epochs,
         callbacks=[
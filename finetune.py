@@ -2,22 +2,12 @@
 import pytorch_lightning as pl
 
 from datasets import load_dataset
-from utils import get_finetune_args
+from utils import get_finetune_args, get_model
 from pytorch_lightning import Trainer
 from data.data_module import ClfDataModule
 from pytorch_lightning.loggers import WandbLogger
 from helper.finetuner import ClfFinetune, HgCkptIO
 from pytorch_lightning.callbacks import ModelCheckpoint
-from transformers import AutoModelForSequenceClassification
-
-
-def get_model(name, num_labels):
-    model = AutoModelForSequenceClassification.from_pretrained(name, num_labels=num_labels)
-    model.config.output_attentions = True
-    model.config.output_hidden_states = True
-    model.config.output_values = True
-
-    return model
 
 
 if __name__ == '__main__':
@@ -37,7 +27,6 @@ if __name__ == '__main__':
         tokenizer=model_name,
         max_length=args.max_length,
         batch_size=args.batch_size,
-        epochs=args.epochs,
         num_workers=args.num_workers
     )
 
@@ -46,6 +35,7 @@ if __name__ == '__main__':
         learning_rate=args.learning_rate,
         weight_decay=args.weight_decay,
         eps=args.eps,
+        optimizer=args.optimizer,
     )
 
     ckpt_callback = ModelCheckpoint(
@@ -58,7 +48,7 @@ if __name__ == '__main__':
 
     trainer = Trainer(
         # gpus=1,
-        plugins=[HgCkptIO()],
+        plugins=[HgCkptIO('hg_model')],
         max_epochs=args.epochs,
         logger=wandb_logger,
         callbacks=[ckpt_callback]
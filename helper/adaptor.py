@@ -20,6 +20,20 @@ class BaseAdaptor(nn.Module):
        self.name = name
        self.w = w
 
+    @staticmethod
+    def stack_inputs(feat_t, feat_s):
+        '''
+        * Stacks the per-layer features so that all layers are reduced by a single op.
+        * Uses a 'last' strategy which means `feat_s` only learns from the last
+          `len(feat_s)` layers from `feat_t`
+
+        :param feat_t (Tuple): contains tensors of shape (*batch_size*, ...)
+        :param feat_s (Tuple): contains tensors of shape (*batch_size*, ...)
+        :return: two tensors of shape (*num_layers* x *batch_size*, ...), layer-major
+        '''
+        s_len = len(feat_s)
+        return torch.cat(feat_t[-s_len:]), torch.cat(feat_s)
+
 
 class LogitMSE(BaseAdaptor):
 
@@ -84,21 +98,17 @@ class AttnTinyBERT(BaseAdaptor):
         '''
         bsz, head, seq, seq = attn_t[0].size()
         s_len = len(attn_s)
-        # The `last` strategy
-        attn_t = torch.cat(attn_t[-s_len:])
-        attn_s = torch.cat(attn_s)
+        attn_t, attn_s = self.stack_inputs(attn_t, attn_s)
 
         if mask is None:
             loss = F.mse_loss(attn_s, attn_t)
         else:
             norm_term = mask.sum() * s_len * head
-            mask = torch.cat([mask for _ in range(s_len)])
-            mask = mask.to(attn_s).unsqueeze(1).expand(-1, head, -1)  # (bs, num_of_heads, len)
+            mask = mask.repeat(s_len, 1).to(attn_s)
+            mask = (mask.unsqueeze(-1) * mask.unsqueeze(1)).unsqueeze(1)  # (bs, 1, len, len)
 
-            attn_t_masked = (attn_t * mask.unsqueeze(-1) * mask.unsqueeze(2))
-            attn_s_masked = (attn_s * mask.unsqueeze(-1) * mask.unsqueeze(2))
-
-            loss = F.mse_loss(attn_s_masked, attn_t_masked, reduction='none').sum() / norm_term
+            # Masking the difference once equals masking both matrices as the mask is binary
+            loss = ((attn_s - attn_t) * mask).pow(2).sum() / norm_term
 
         return loss
 
@@ -121,16 +131,14 @@ class HidnTinyBERT(BaseAdaptor):
         bsz, seq, s_dim = hidn_s[0].size()
         s_len = len(hidn_s)
 
-        hidn_t = torch.cat(hidn_t[-s_len:])
-        hidn_s = torch.cat(hidn_s)
+        hidn_t, hidn_s = self.stack_inputs(hidn_t, hidn_s)
         hidn_s = self.linear(hidn_s)
 
         if mask is None:
             loss = F.mse_loss(hidn_s, hidn_t)
         else:
             norm_term = mask.sum() * s_len * s_dim
-            mask = torch.cat([mask for _ in range(s_len)])
-            mask = mask.to(hidn_s)
+            mask = mask.repeat(s_len, 1).to(hidn_s)
             loss = (F.mse_loss(hidn_s, hidn_t, reduction='none') * mask.unsqueeze(-1)).sum() / norm_term
 
         return loss
@@ -183,8 +191,7 @@ class AttnMiniLM(BaseAdaptor):
         bsz, head, seq, seq = attn_s[0].size()
         s_len = len(attn_s)
 
-        attn_t = torch.cat(attn_t[-s_len:])
-        attn_s = torch.cat(attn_s)
+        attn_t, attn_s = self.stack_inputs(attn_t, attn_s)
 
         if mask is None:
             attn_s = attn_s + 1e-6 / attn_s.sum(dim=-1, keepdim=True)
@@ -192,8 +199,7 @@ class AttnMiniLM(BaseAdaptor):
             loss = F.kl_div(attn_s.log(), attn_t)
         else:
             norm_term = mask.sum() * s_len * head
-            mask = torch.cat([mask for _ in range(s_len)])
-            mask = mask.to(attn_s).unsqueeze(1).expand(-1, head, -1)
+            mask = mask.repeat(s_len, 1).to(attn_s).unsqueeze(1).expand(-1, head, -1)
 
             # Smooth as some attention scores might be zero
             attn_s = attn_s + (mask * 1e-6).unsqueeze(2)
@@ -229,12 +235,11 @@ class ValMiniLM(BaseAdaptor):
         _, _, _, s_dim = val_s[0].size()
         s_len = len(val_s)
 
-        val_t = torch.cat(val_t[-s_len:])
-        val_s = torch.cat(val_s)
+        val_t, val_s = self.stack_inputs(val_t, val_s)
 
         if mask is None:
-            val_t = val_t.reshape(batch * head, seq, t_dim)
-            val_s = val_s.reshape(batch * head, seq, s_dim)
+            val_t = val_t.reshape(s_len * batch * head, seq, t_dim)
+            val_s = val_s.reshape(s_len * batch * head, seq, s_dim)
 
             reln_t = torch.bmm(val_t, val_t.transpose(1, 2)) / math.sqrt(t_dim)
             reln_s = torch.bmm(val_s, val_s.transpose(1, 2)) / math.sqrt(s_dim)
@@ -245,8 +250,8 @@ class ValMiniLM(BaseAdaptor):
             loss = F.kl_div(reln_s.log(), reln_t)
         else:
             norm_term = mask.sum() * s_len * head
-            mask = torch.cat([mask for _ in range(s_len)])
-            mask = torch.cat([mask for _ in range(head)]).to(val_t)
+            # Follow the (layer, batch, head) order of the reshaped values below
+            mask = mask.repeat(s_len, 1).repeat_interleave(head, dim=0).to(val_t)
             # For masked items, Softmax(-inf) = 0
             mask_reversed = (1.0 - mask) * -10000.0
 
@@ -293,9 +298,9 @@ class HidnPKD(BaseAdaptor):
             :param hidn_t (Tuple): contains tensors of shape  (*batch_size*, *length*, *dim*)
             :param hidn_s (Tuple): contains tensors of shape  (*batch_size*, *length*, *dim*)
         '''
-        s_len = len(hidn_s)
-        cls_t = torch.cat(hidn_t[-s_len:])[:, 0]
-        cls_s = torch.cat(hidn_s)[:, 0]
+        cls_t, cls_s = self.stack_inputs(
+            [h[:, 0] for h in hidn_t], [h[:, 0] for h in hidn_s]
+        )
 
         cls_s = self.linear(cls_s)
 
@@ -0,0 +1,104 @@
+"""
+Checkpoint IO shared by the finetuner and the distillers
+"""
+
+import os
+import threading
+
+from typing import Any, Dict, Optional
+from pytorch_lightning.plugins import CheckpointIO
+from pytorch_lightning.utilities.types import _PATH
+from pytorch_lightning.utilities.cloud_io import get_filesystem
+from safetensors.torch import load_file, save_file
+from transformers import AutoConfig, AutoModelForSequenceClassification
+
+
+class HgCkptIO(CheckpointIO):
+    '''
+    Checkpoint IO that saves a hugging-face model held in the checkpoint under `key`,
+    'hg_model' for `ClfFinetune` and 'student' for the distillers
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.writer = None
+        self.error = None
+
+    def save_checkpoint(self, checkpoint: Dict[str, Any], path: _PATH, storage_options: Optional[Any] = None) -> None:
+        '''Save the fine-tuned model in a hugging-face style, with the weights in `model.safetensors`.
+        The weights are written in a background thread, load them with `safetensors.torch.load_file`.
+
+        Args:
+            checkpoint: ckpt, but only `self.key` matters
+            path: path to save the ckpt
+            storage_options: not used
+        '''
+        fs = get_filesystem(path)
+        fs.makedirs(path, exist_ok=True)
+
+        model = checkpoint[self.key]
+        model.config.to_json_file(os.path.join(path, 'config.json'))
+        # Copy on the calling thread as training keeps updating the weights in place
+        state = {k: v.detach().to('cpu', copy=True).contiguous() for k, v in model.state_dict().items()}
+
+        self.wait()
+        self.writer = threading.Thread(target=self.write_weights, args=(state, path))
+        self.writer.start()
+
+    def write_weights(self, state, path):
+        # Write to a temporary file first so that a checkpoint is never half written
+        tmp_file = os.path.join(path, 'model.safetensors.tmp')
+        try:
+            save_file(state, tmp_file, metadata={'format': 'pt'})
+            os.replace(tmp_file, os.path.join(path, 'model.safetensors'))
+        except Exception as e:
+            # Raised by `wait` on the training thread
+            self.error = e
+
+    def wait(self):
+        '''Block until the last checkpoint is written, raising the error of the writer if any'''
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def teardown(self) -> None:
+        self.wait()
+
+    def load_checkpoint(self, path: _PATH, storage_options: Optional[Any] = None) -> Dict[str, Any]:
+        pass
+
+    def remove_checkpoint(self, path: _PATH) -> None:
+        """Remove checkpoint file from the filesystem.
+
+        Args:
+            path: Path to checkpoint
+        """
+        self.wait()
+        fs = get_filesystem(path)
+        if fs.exists(path):
+            fs.rm(path, recursive=True)
+
+
+def load_pretrained(name, **kwargs):
+    '''
+    Load a classifier from the hub, a `save_pretrained` directory or a checkpoint saved by `HgCkptIO`.
+    The latter only holds `model.safetensors`, which `from_pretrained` of transformers 4.18 can not read.
+
+    :param name: model name or path
+    :param kwargs: config overrides, e.g. num_labels
+    '''
+    weights_file = os.path.join(name, 'model.safetensors')
+    if not os.path.isfile(weights_file):
+        return AutoModelForSequenceClassification.from_pretrained(name, **kwargs)
+
+    config = AutoConfig.from_pretrained(name, **kwargs)
+    model = AutoModelForSequenceClassification.from_config(config)
+    model.load_state_dict(load_file(weights_file))
+    # Like `from_pretrained`
+    model.eval()
+
+    return model
@@ -3,57 +3,60 @@ Distillers for knowledge distillation on different layers
 """
 
 import os
+import json
+import shutil
 import wandb
 import torchmetrics
+import numpy as np
 
 from helper.adaptor import *
-from typing import Any, Dict, Optional
+from helper.optim import build_optimizer_and_scheduler, tag_weight_decay
+from helper.ckpt_io import HgCkptIO
+from helper.mixins import CkptWaitMixin, PinnedBatchMixin
+from concurrent.futures import ThreadPoolExecutor
 from pytorch_lightning import LightningModule
-from pytorch_lightning.plugins import CheckpointIO
-from pytorch_lightning.utilities.types import _PATH
-from transformers import get_linear_schedule_with_warmup
-from pytorch_lightning.utilities.cloud_io import get_filesystem
+from pytorch_lightning.utilities import rank_zero_warn
+from transformers.modeling_outputs import SequenceClassifierOutput
 
 
-class HgCkptIO(CheckpointIO):
+str2dtype = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
 
-    def save_checkpoint(self, checkpoint: Dict[str, Any], path: _PATH, storage_options: Optional[Any] = None) -> None:
-        '''Save the fine-tuned model in a hugging-face style.
 
-        Args:
-            checkpoint: ckpt, but only key 'hg_model' matters
-            path: path to save the ckpt
-            storage_options: not used
-        '''
-        fs = get_filesystem(path)
-        fs.makedirs(os.path.dirname(path), exist_ok=True)
-        checkpoint['student'].save_pretrained(path)
-
-    def load_checkpoint(self, path: _PATH, storage_options: Optional[Any] = None) -> Dict[str, Any]:
-        pass
+def teacher_dtype(precision):
+    '''
+    dtype of the teacher for `precision`, falling back to fp32 where the half precisions
+    are unsupported or slow: both need a GPU, bf16 one that supports it (Ampere or newer)
+    '''
+    if precision != 'fp32' and not torch.cuda.is_available():
+        rank_zero_warn(f"No GPU available, the teacher runs in fp32 instead of {precision}")
+        return torch.float32
+    bf16_supported = getattr(torch.cuda, 'is_bf16_supported', None)
+    if precision == 'bf16' and not (bf16_supported and bf16_supported()):
+        rank_zero_warn("The GPU does not support bf16, the teacher runs in fp32 instead")
+        return torch.float32
 
-    def remove_checkpoint(self, path: _PATH) -> None:
-        """Remove checkpoint file from the filesystem.
-
-        Args:
-            path: Path to checkpoint
-        """
-        fs = get_filesystem(path)
-        if fs.exists(path):
-            fs.rm(path, recursive=True)
+    return str2dtype[precision]
 
 
-class BaseDistiller(LightningModule):
+class BaseDistiller(PinnedBatchMixin, CkptWaitMixin, LightningModule):
     """
     ====================================
         A distiller for all layers
     ====================================
     """
 
+    # Which layers are distilled, one of 'inter', 'pred' or 'both'
+    default_distill_mode = 'both'
+
     def __init__(self, teacher, student, adaptors,dm,
                  temperature=4, learning_rate=1e-4,
                  weight_decay=5e-5, eps=1e-8,
-                 plot_attention=False):
+                 plot_attention=False, plot_every=5, teacher_precision='fp32',
+                 compile_model=False, distill_mode=None, optimizer='adamw'):
 
         super().__init__()
 
@@ -68,20 +71,51 @@ class BaseDistiller(LightningModule):
             'HidnPKD': HidnPKD(teacher.config.hidden_size, student.config.hidden_size),
         }
 
-        self.num_training_steps = dm.num_training_steps
-        self.num_warmup_steps = dm.num_warmup_steps
+        self.warmup_ratio = dm.warmup_ratio
         self.plot_attention = plot_attention
+        self.plot_every = plot_every
+        self.plot_executor = None
+        self.plot_future = None
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
         self.eps = eps
+        self.optimizer_name = optimizer
 
         self.teacher = teacher
         self.student = student
+        # The teacher is frozen, so it can live in a lower precision for good
+        self.teacher.to(dtype=teacher_dtype(teacher_precision))
+        # Frozen parameters are also left out of the gradient all-reduce under DDP
+        self.teacher.requires_grad_(False)
+        # Set once here, `train` keeps the teacher out of the training mode
+        self.teacher.eval()
+
+        # Without the classification heads, used to train in 'inter' mode, see `forward`.
+        # A tuple so that the modules are not registered twice.
+        self.base_models = (self.teacher.base_model, self.student.base_model)
+
+        # Fuse the pointwise ops of both models, requires PyTorch 2
+        compile_model = compile_model and hasattr(torch, 'compile')
+        if compile_model:
+            self.student = torch.compile(self.student, mode='reduce-overhead', dynamic=True)
+            self.teacher = torch.compile(self.teacher, mode='max-autotune')
 
         self.adaptors = torch.nn.ModuleList([
             str2adaptors[adaptor] for adaptor in adaptors
         ])
 
+        self.distill_mode = distill_mode or self.default_distill_mode
+        # Features the adaptors consume, the models only need to output these
+        self.features = {adaptor.name.split(':')[0] for adaptor in self.adaptors}
+        if self.distill_mode == 'inter' and 'logits' in self.features:
+            raise ValueError("Logit adaptors can not be used when distill_mode is 'inter'")
+        if self.distill_mode == 'pred' and self.features - {'logits'}:
+            raise ValueError("Only logit adaptors can be used when distill_mode is 'pred'")
+        if compile_model and self.distill_mode == 'inter':
+            # `base_model` of a compiled model is its uncompiled inner module, so compile the bases too
+            self.base_models = (torch.compile(self.base_models[0], mode='max-autotune'),
+                                torch.compile(self.base_models[1], mode='reduce-overhead', dynamic=True))
+
         # Metrics
         num_labels = teacher.config.num_labels
         self.acc_s = torchmetrics.Accuracy(num_classes=num_labels)
@@ -90,6 +124,15 @@ class BaseDistiller(LightningModule):
         self.test_acc = torchmetrics.Accuracy(num_classes=num_labels)
         self.test_f1 = torchmetrics.F1Score(num_classes=num_labels)
 
+        tag_weight_decay(self)
+
+    def train(self, mode=True):
+        '''Switch the student and the adaptors only, the teacher always stays in eval mode'''
+        super().train(mode)
+        self.teacher.eval()
+
+        return self
+
     def compute_loss(self, out_t, out_s, mask=None):
         loss_dict = {
             'pred:nll': out_s.get('loss', 0),
@@ -104,41 +147,185 @@ class BaseDistiller(LightningModule):
 
         return loss_dict
 
-    def forward(self, batch):
-        self.teacher.eval()
-        with torch.no_grad():
-            teacher_out = self.teacher(**batch)
-        student_out = self.student(**batch)
+    @staticmethod
+    def cast_features(out, dtype):
+        '''
+        Cast the floating point features in a model output to `dtype` in place
+
+        :param out: ModelOutput of the teacher
+        :param dtype: target dtype, usually the dtype of the student
+        '''
+        for k, v in out.items():
+            if torch.is_tensor(v) and v.is_floating_point():
+                out[k] = v.to(dtype)
+            elif isinstance(v, tuple):
+                out[k] = tuple(t.to(dtype) for t in v)
+
+        return out
+
+    def build_teacher_cache(self, dm, path):
+        '''
+        Precompute the teacher features of the train and validation splits missing under `path`
+
+        :param dm: a `ClfDataModule`, set up here if a split is missing
+        :param path: cache directory, see `ClfDataModule.teacher_cache`
+        '''
+        missing = [split for split in ['train', 'validation'] if not os.path.exists(os.path.join(path, split))]
+        if not missing:
+            return
+
+        dm.setup()
+        for split in missing:
+            self.precompute_teacher(dm.teacher_dataloader(split), os.path.join(path, split))
+
+    def precompute_teacher(self, dataloader, path):
+        '''
+        Run the teacher once over `dataloader` and dump the features required by the
+        adaptors into memory-mapped `.npy` files under `path`, where row i belongs to
+        the i-th example. `dataloader` must therefore iterate its dataset in order.
+        Only the layers matched with the student are kept, see `last_layers`.
+
+        :param dataloader: a sequential dataloader, see `ClfDataModule.teacher_dataloader`
+        :param path: directory to save the features
+        '''
+        # Processes started together, e.g. by torchrun or SLURM, would all write the same files
+        world_size = int(os.environ.get('WORLD_SIZE', os.environ.get('SLURM_NTASKS', 1)))
+        if world_size > 1:
+            raise RuntimeError(f"Teacher cache {path} is missing, it can not be built by {world_size} processes "
+                               f"at once. Build it with a single process first, e.g. with --devices 1")
+
+        names = self.cached_features()
+        num_layers = self.student.config.num_hidden_layers
+
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.teacher.to(device)
+
+        # Write to a temporary directory so that an interrupted run leaves no partial cache
+        tmp_path = path.rstrip('/') + '.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+
+        features, offset, max_length = {}, 0, None
+        with torch.inference_mode():
+            for batch in dataloader:
+                out_t = self.teacher(**{k: v.to(device, non_blocking=True) for k, v in batch.items()},
+                                     **self.output_flags(names))
+                bsz, max_length = batch['input_ids'].size()
+
+                for name in names:
+                    feature = out_t.get(name)
+                    # Layers are stacked on dim 1, i.e. (batch_size, num_layers, ...)
+                    if isinstance(feature, tuple):
+                        feature = torch.stack(self.last_layers(name, feature, num_layers), dim=1)
+                    feature = feature.to(torch.float16).cpu().numpy()
+
+                    if name not in features:
+                        features[name] = np.lib.format.open_memmap(
+                            os.path.join(tmp_path, name + '.npy'), mode='w+', dtype=np.float16,
+                            shape=(len(dataloader.dataset),) + feature.shape[1:]
+                        )
+                    features[name][offset:offset + bsz] = feature
+
+                offset += bsz
+
+        for feature in features.values():
+            feature.flush()
+        del features
+
+        # Describe what built the cache so that a stale one is detected, see `TeacherCache.check`
+        manifest = {
+            'teacher': self.teacher.config.name_or_path,
+            'max_length': max_length,
+            'num_examples': offset,
+            'num_layers': num_layers,
+            'features': sorted(names),
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    def cached_features(self):
+        '''Teacher features read from the cache, those of the adaptors plus the attentions to plot'''
+        names = {'logits'} | self.features
+        if self.plot_attention:
+            names.add('attentions')
+
+        return names
+
+    def setup(self, stage=None):
+        # The data module checks the data side of the cached features, the models are checked here
+        caches = getattr(self.trainer.datamodule, 'caches', {})
+        for cache in caches.values():
+            cache.check(features=self.cached_features(),
+                        teacher=self.teacher.config.name_or_path,
+                        num_layers=self.student.config.num_hidden_layers)
+
+    @staticmethod
+    def last_layers(name, layers, num_layers):
+        '''
+        Keep the teacher layers the adaptors read, i.e. the last `num_layers` ones,
+        see `BaseAdaptor.stack_inputs`. Hidden states start with the embedding output,
+        so the last `num_layers + 1` are kept, plus the embedding output for `EmbdTinyBERT`.
+
+        :param name: feature name
+        :param layers: tuple of per-layer features of the teacher
+        :param num_layers: number of student layers
+        '''
+        if name != 'hidden_states':
+            return layers[-num_layers:]
+        if len(layers) <= num_layers + 2:
+            return layers
+        return layers[:1] + layers[-(num_layers + 1):]
+
+    @staticmethod
+    def output_flags(features):
+        '''
+        Model kwargs to only output the intermediate `features` needed. Without attentions,
+        the attention layers can use the fused `scaled_dot_product_attention` kernel.
+        '''
+        return {
+            'output_attentions': 'attentions' in features,
+            'output_hidden_states': 'hidden_states' in features,
+            'output_values': 'values' in features,
+        }
+
+    def forward(self, batch, output_attentions=False):
+        '''
+        :param batch: batch of model inputs
+        :param output_attentions: return attentions even if no adaptor needs them, e.g. for plotting
+        '''
+        # Teacher features precomputed by `precompute_teacher` are attached by the data module
+        cached = {k[len('teacher_'):]: batch.pop(k) for k in list(batch) if k.startswith('teacher_')}
+
+        features = self.features | {'attentions'} if output_attentions else self.features
+        teacher, student, inputs = self.teacher, self.student, dict(batch, **self.output_flags(features))
+        if self.training and self.distill_mode == 'inter':
+            # Only intermediate layers are distilled, skip the classification heads and their loss
+            teacher, student = self.base_models
+            inputs.pop('labels', None)
+
+        if cached:
+            teacher_out = SequenceClassifierOutput(**{
+                k: v if k == 'logits' else v.unbind(dim=1) for k, v in cached.items()
+            })
+        else:
+            # Inference tensors can not be saved for backward by the adaptors,
+            # hence `no_grad` rather than `inference_mode`
+            with torch.no_grad():
+                teacher_out = teacher(**inputs)
+        student_out = student(**inputs)
+
+        self.cast_features(teacher_out, self.student.dtype)
 
         return teacher_out, student_out
 
     def configure_optimizers(self):
-        no_decay = ["bias", "LayerNorm.weight"]
-
-        parameters = [(n, p) for n, p in self.named_parameters() if 'teacher' not in n]
-
-        optimizer_grouped_parameters = [
-            {
-                "params": [p for n, p in parameters if not any(nd in n for nd in no_decay)],
-                "weight_decay": self.weight_decay,
-            },
-            {
-                "params": [p for n, p in parameters if any(nd in n for nd in no_decay)],
-                "weight_decay": 0.0,
-            },
-        ]
-
-        optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
-                                      lr=self.learning_rate,
-                                      eps=self.eps, )
-
-        scheduler = get_linear_schedule_with_warmup(
-            optimizer,
-            num_training_steps=self.num_training_steps,
-            num_warmup_steps=self.num_warmup_steps
-        )
+        # The teacher is frozen
+        named_params = ((n, p) for n, p in self.named_parameters() if not n.startswith('teacher.'))
 
-        return [optimizer], [{"scheduler": scheduler, "interval": "step"}]
+        return build_optimizer_and_scheduler(named_params, self)
 
     def training_step(self, batch, idx):
         loss_dict = self.compute_loss(
@@ -163,7 +350,10 @@ class BaseDistiller(LightningModule):
 
     def validation_step(self, batch, idx):
         labels = batch['labels']
-        out_t, out_s = self(batch)
+        # Plot attention matrices of the first item in the first batch every `plot_every` epochs
+        plot = self.plot_attention and idx == 0 and self.trainer.is_global_zero \
+            and self.current_epoch % self.plot_every == 0
+        out_t, out_s = self(batch, output_attentions=plot)
 
         loss_dict = self.compute_loss(out_t, out_s, batch.get('attention_mask'))
 
@@ -174,46 +364,59 @@ class BaseDistiller(LightningModule):
         self.f1_s(pred_s, labels)
         self.acc_s(pred_s, labels)
 
-        # Plot attention matrices of the first item in the first batch
-        if self.plot_attention and idx == 0:
-            attn_t = out_t.attentions
-            attn_s = out_s.attentions
+        if plot:
             mask = batch['attention_mask']
 
-            first_zero_index = 0
-            for index, item in enumerate(mask[0]):
-                if item == 0:
-                    first_zero_index = index
-                    break
+            # One copy to host instead of a sync per token
+            m = mask[0].cpu()
+            nz = (m == 0).nonzero(as_tuple=False)
+            first_zero_index = int(nz[0]) if nz.numel() else m.numel()
 
             # Unmasked text
-            axis = [i for i in range(first_zero_index)]
+            attn_t = out_t.attentions[-1][0, 0, :first_zero_index, :first_zero_index].detach().float().cpu()
+            attn_s = out_s.attentions[-1][0, 0, :first_zero_index, :first_zero_index].detach().float().cpu()
+
+            # Upload in the background so that wandb does not block the next batch
+            if self.plot_executor is None:
+                self.plot_executor = ThreadPoolExecutor(max_workers=1)
+            self.check_plot()
+            self.plot_future = self.plot_executor.submit(self.plot_attentions, attn_t, attn_s, self.current_epoch)
 
-            wandb.log({'%d-attn_t[-1]' % self.current_epoch: wandb.plots.HeatMap(axis, axis,
-                                                                                 attn_t[-1][0, 0, :, :]
-                                                                                 .detach().cpu(),
-                                                                                 show_text=False)})
+        # Running sum instead of keeping every batch loss until the epoch ends
+        self.val_loss_sum += out_s.loss.detach()
+        self.val_n += 1
 
-            wandb.log({'%d-attn_s[-1]' % self.current_epoch: wandb.plots.HeatMap(axis, axis,
-                                                                                 attn_s[-1][0, 0, :, :]
-                                                                                 .detach().cpu(),
-                                                                                 show_text=False)})
+    @staticmethod
+    def plot_attentions(attn_t, attn_s, epoch):
+        '''
+        Log heatmaps of a teacher and a student attention matrix to wandb
+
+        :param attn_t: Tensor of shape (length, length) on cpu
+        :param attn_s: Tensor of shape (length, length) on cpu
+        :param epoch: current epoch, used as prefix of the plot names
+        '''
+        axis = [i for i in range(attn_t.size(0))]
+
+        wandb.log({'%d-attn_t[-1]' % epoch: wandb.plots.HeatMap(axis, axis, attn_t, show_text=False)})
+        wandb.log({'%d-attn_s[-1]' % epoch: wandb.plots.HeatMap(axis, axis, attn_s, show_text=False)})
 
-        return {'val_loss': out_s.loss}
+    def on_test_epoch_start(self) -> None:
+        self.test_acc_sum = 0.0
+        self.test_f1_sum = 0.0
+        self.test_n = 0
 
     def test_step(self, batch, idx):
         labels = batch['labels']
         _, out_s = self(batch)
         pred_s = torch.argmax(out_s.logits, dim=1)
 
-        return {'test_acc': self.test_acc(pred_s, labels),
-                'test_f1': self.test_f1(pred_s, labels)}
+        self.test_acc_sum += self.test_acc(pred_s, labels)
+        self.test_f1_sum += self.test_f1(pred_s, labels)
+        self.test_n += 1
 
     def test_epoch_end(self, outputs) -> None:
-        test_acc = torch.stack([x["test_acc"] for x in outputs]).mean()
-        test_f1 = torch.stack([x["test_f1"] for x in outputs]).mean()
-        self.log("test_acc", test_acc, prog_bar=True, logger=True)
-        self.log("test_f1", test_f1, prog_bar=True, logger=True)
+        self.log("test_acc", self.test_acc_sum / self.test_n, prog_bar=True, logger=True, sync_dist=True)
+        self.log("test_f1", self.test_f1_sum / self.test_n, prog_bar=True, logger=True, sync_dist=True)
 
     def predict_step(self, batch, idx):
         batch.pop('labels')
@@ -222,17 +425,42 @@ class BaseDistiller(LightningModule):
 
         return pred_s
 
+    def on_validation_epoch_start(self) -> None:
+        self.val_loss_sum = 0.0
+        self.val_n = 0
+
     def validation_epoch_end(self, outputs) -> None:
-        val_loss = torch.stack([x["val_loss"] for x in outputs]).mean()
-        self.log("val_loss", val_loss, prog_bar=True, logger=True)
+        self.log("val_loss", self.val_loss_sum / self.val_n, prog_bar=True, logger=True, sync_dist=True)
         self.log('val_f1', self.f1_s)
         self.log('val_acc', self.acc_s)
+        self.check_plot(wait=False)
+
+    def check_plot(self, wait=True):
+        '''
+        Re-raise the error of the last attention plot if any
+
+        :param wait: wait for the plot to finish, otherwise only check it if it is done
+        '''
+        future = self.plot_future
+        if future is not None and (wait or future.done()):
+            self.plot_future = None
+            future.result()
+
+    def teardown(self, stage=None):
+        try:
+            if self.plot_executor is not None:
+                self.plot_executor.shutdown()
+                self.plot_executor = None
+            self.check_plot()
+        finally:
+            super().teardown(stage)
 
     def on_save_checkpoint(self, checkpoint) -> None:
         """
             For the customed CheckpointIO
         """
-        checkpoint['student'] = self.student
+        # Unwrap the student in case it is compiled
+        checkpoint['student'] = getattr(self.student, '_orig_mod', self.student)
 
 
 class InterDistiller(BaseDistiller):
@@ -241,6 +469,8 @@ class InterDistiller(BaseDistiller):
         Archived by removing pred layer losses
     """
 
+    default_distill_mode = 'inter'
+
     def training_step(self, batch, idx):
         '''
             Rewrite training_step and remove prediction layer losses
@@ -271,31 +501,11 @@ class PredDistiller(BaseDistiller):
         Archived by fixing inter layer weights
     """
 
-    def configure_optimizers(self):
+    default_distill_mode = 'pred'
 
-        no_decay = ["bias", "LayerNorm.weight"]
-
-        parameters = [(n, p) for n, p in self.named_parameters() if 'classifier' in n]
-
-        optimizer_grouped_parameters = [
-            {
-                "params": [p for n, p in parameters if not any(nd in n for nd in no_decay)],
-                "weight_decay": self.weight_decay,
-            },
-            {
-                "params": [p for n, p in parameters if any(nd in n for nd in no_decay)],
-                "weight_decay": 0.0,
-            },
-        ]
-
-        optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
-                                      lr=self.learning_rate,
-                                      eps=self.eps, )
-
-        scheduler = get_linear_schedule_with_warmup(
-            optimizer,
-            num_training_steps=self.num_training_steps,
-            num_warmup_steps=self.num_warmup_steps
-        )
+    def configure_optimizers(self):
+        # Only the classifier of the student is trained
+        named_params = ((n, p) for n, p in self.named_parameters()
+                        if n.startswith('student.') and 'classifier' in n)
 
-        return [optimizer], [{"scheduler": scheduler, "interval": "step"}]
+        return build_optimizer_and_scheduler(named_params, self)
@@ -1,56 +1,24 @@
-from typing import Any, Dict, Optional
-from pytorch_lightning.utilities.types import _PATH
-
-import os
 import torch
 import torchmetrics
 from pytorch_lightning import LightningModule
-from pytorch_lightning.plugins import CheckpointIO
-from transformers import get_linear_schedule_with_warmup
-
-from pytorch_lightning.utilities.cloud_io import get_filesystem
-
-
-class HgCkptIO(CheckpointIO):
-
-    def save_checkpoint(self, checkpoint: Dict[str, Any], path: _PATH, storage_options: Optional[Any] = None) -> None:
-        '''Save the fine-tuned model in a hugging-face style.
-
-        Args:
-            checkpoint: ckpt, but only key 'hg_model' matters
-            path: path to save the ckpt
-            storage_options: not used
-        '''
-        fs = get_filesystem(path)
-        fs.makedirs(os.path.dirname(path), exist_ok=True)
-        checkpoint['hg_model'].save_pretrained(path)
-
-    def load_checkpoint(self, path: _PATH, storage_options: Optional[Any] = None) -> Dict[str, Any]:
-        pass
-
-    def remove_checkpoint(self, path: _PATH) -> None:
-        """Remove checkpoint file from the filesystem.
 
-        Args:
-            path: Path to checkpoint
-        """
-        fs = get_filesystem(path)
-        if fs.exists(path):
-            fs.rm(path, recursive=True)
+from helper.optim import build_optimizer_and_scheduler, tag_weight_decay
+from helper.ckpt_io import HgCkptIO
+from helper.mixins import CkptWaitMixin, PinnedBatchMixin
 
 
-class ClfFinetune(LightningModule):
+class ClfFinetune(PinnedBatchMixin, CkptWaitMixin, LightningModule):
 
     def __init__(self, model, dm,
-                 learning_rate=1e-4, weight_decay=5e-5, eps=1e-8):
+                 learning_rate=1e-4, weight_decay=5e-5, eps=1e-8, optimizer='adamw'):
 
         super().__init__()
 
-        self.num_training_steps = dm.num_training_steps
-        self.num_warmup_steps = dm.num_warmup_steps
+        self.warmup_ratio = dm.warmup_ratio
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
         self.eps = eps
+        self.optimizer_name = optimizer
 
         self.model = model
 
@@ -59,36 +27,13 @@ class ClfFinetune(LightningModule):
         self.acc = torchmetrics.Accuracy(num_classes=num_labels)
         self.f1 = torchmetrics.F1Score(num_classes=num_labels)
 
+        tag_weight_decay(self)
+
     def forward(self, batch):
         return self.model(**batch)
 
     def configure_optimizers(self):
-        no_decay = ["bias", "LayerNorm.weight"]
-
-        parameters = [(n, p) for n, p in self.named_parameters()]
-
-        optimizer_grouped_parameters = [
-            {
-                "params": [p for n, p in parameters if not any(nd in n for nd in no_decay)],
-                "weight_decay": self.weight_decay,
-            },
-            {
-                "params": [p for n, p in parameters if any(nd in n for nd in no_decay)],
-                "weight_decay": 0.0,
-            },
-        ]
-
-        optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
-                                      lr=self.learning_rate,
-                                      eps=self.eps,)
-
-        scheduler = get_linear_schedule_with_warmup(
-            optimizer,
-            num_training_steps=self.num_training_steps,
-            num_warmup_steps=self.num_warmup_steps
-        )
-
-        return [optimizer], [{"scheduler": scheduler, "interval": "step"}]
+        return build_optimizer_and_scheduler(self.named_parameters(), self)
 
     def training_step(self, batch, idx):
         loss = self(batch).loss
@@ -102,11 +47,16 @@ class ClfFinetune(LightningModule):
         self.f1(pred, labels)
         self.acc(pred, labels)
 
-        return {'val_loss': out.loss}
+        # Running sum instead of keeping every batch loss until the epoch ends
+        self.val_loss_sum += out.loss.detach()
+        self.val_n += 1
+
+    def on_validation_epoch_start(self) -> None:
+        self.val_loss_sum = 0.0
+        self.val_n = 0
 
     def validation_epoch_end(self, outputs) -> None:
-        val_loss = torch.stack([x["val_loss"] for x in outputs]).mean()
-        self.log("val_loss", val_loss, prog_bar=True, logger=True)
+        self.log("val_loss", self.val_loss_sum / self.val_n, prog_bar=True, logger=True, sync_dist=True)
         self.log('val_acc', self.acc, logger=True)
         self.log('val_f1', self.f1, logger=True)
 
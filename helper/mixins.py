@@ -0,0 +1,29 @@
+"""
+Lightning hooks shared by the finetuner and the distillers
+"""
+
+from helper.ckpt_io import HgCkptIO
+
+
+class PinnedBatchMixin:
+    '''
+    Copies batches from pinned memory to the device asynchronously, see `ClfDataModule.loader_kwargs`
+    '''
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Batches are in pinned memory, so the copy can overlap with the running kernels
+        return {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+
+
+class CkptWaitMixin:
+    '''
+    Waits for the checkpoint `HgCkptIO` writes in the background when the trainer tears down,
+    so that the best checkpoint can be loaded as soon as `fit` returns
+    '''
+
+    def teardown(self, stage=None):
+        checkpoint_io = self.trainer.strategy.checkpoint_io
+        if isinstance(checkpoint_io, HgCkptIO):
+            checkpoint_io.wait()
+
+        super().teardown(stage)
@@ -0,0 +1,82 @@
+"""
+Optimizers shared by the finetuner and the distillers
+"""
+
+import torch
+
+from transformers import get_linear_schedule_with_warmup
+
+
+def get_optimizer(name, grouped_parameters, lr, eps):
+    '''
+    :param name: one of 'adamw', 'adamw_fused' or 'adamw8bit'
+    :param grouped_parameters: parameter groups with their own weight decay
+    :param lr: learning rate
+    :param eps: eps of AdamW
+    '''
+    if name == 'adamw':
+        return torch.optim.AdamW(grouped_parameters, lr=lr, eps=eps)
+    if name == 'adamw_fused':
+        # One kernel per step instead of a few per parameter, requires PyTorch 2 and CUDA parameters
+        return torch.optim.AdamW(grouped_parameters, lr=lr, eps=eps, fused=True)
+    if name == 'adamw8bit':
+        # 8-bit optimizer states, requires bitsandbytes
+        import bitsandbytes as bnb
+        return bnb.optim.AdamW8bit(grouped_parameters, lr=lr, eps=eps)
+
+    raise ValueError(f"Unknown optimizer: {name}")
+
+
+NO_DECAY = ("bias", "LayerNorm.weight")
+
+
+def tag_weight_decay(model):
+    '''
+    Mark every parameter of the model that is trained without weight decay,
+    so the optimizer setup does not have to match the names again
+    :param model: the module to tag
+    '''
+    for n, p in model.named_parameters():
+        p._no_decay = n.endswith(NO_DECAY)
+
+
+def build_optimizer_and_scheduler(named_params, hparams):
+    '''
+    :param named_params: (name, parameter) pairs to optimize
+    :param hparams: a module attached to a trainer, with learning_rate, weight_decay, eps,
+                    optimizer_name and warmup_ratio
+    :return: optimizers and schedulers in the format of `configure_optimizers`
+    '''
+    # Split the parameters in a single pass, matching the names only for untagged ones
+    decay_params, no_decay_params = [], []
+    for n, p in named_params:
+        no_decay = getattr(p, '_no_decay', None)
+        if no_decay is None:
+            no_decay = n.endswith(NO_DECAY)
+        (no_decay_params if no_decay else decay_params).append(p)
+
+    optimizer_grouped_parameters = [
+        {
+            "params": decay_params,
+            "weight_decay": hparams.weight_decay,
+        },
+        {
+            "params": no_decay_params,
+            "weight_decay": 0.0,
+        },
+    ]
+
+    optimizer = get_optimizer(hparams.optimizer_name,
+                              optimizer_grouped_parameters,
+                              lr=hparams.learning_rate,
+                              eps=hparams.eps)
+
+    # Steps of each process, which shrink with the number of processes under DDP
+    num_training_steps = hparams.trainer.estimated_stepping_batches
+    scheduler = get_linear_schedule_with_warmup(
+        optimizer,
+        num_training_steps=num_training_steps,
+        num_warmup_steps=int(hparams.warmup_ratio * num_training_steps)
+    )
+
+    return [optimizer], [{"scheduler": scheduler, "interval": "step"}]
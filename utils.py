@@ -2,6 +2,7 @@ import yaml
 
 from typing import List, Dict
 from argparse import ArgumentParser
+from helper.ckpt_io import load_pretrained
 
 
 def serialize_config(config: Dict) -> List[str]:
@@ -38,6 +39,16 @@ def serialize_config(config: Dict) -> List[str]:
     return serialized_config
 
 
+def get_model(name, num_labels):
+    """Load a classifier that outputs attentions, hidden states and values"""
+    model = load_pretrained(name, num_labels=num_labels)
+    model.config.output_attentions = True
+    model.config.output_hidden_states = True
+    model.config.output_values = True
+
+    return model
+
+
 def get_distillation_args(yaml_path):
     parser = ArgumentParser()
 
@@ -58,11 +69,38 @@ def get_distillation_args(yaml_path):
     parser.add_argument('--adaptors', default=[], type=list)
     parser.add_argument("--epochs", default=5, type=int)
     parser.add_argument("--temperature", default=4, type=float)
+    parser.add_argument("--teacher_precision", default='fp32', type=str,
+                        choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of the frozen teacher, fp16 and bf16 fall back to fp32 '
+                             'on devices without support')
+    parser.add_argument("--teacher_cache", default=None, type=str,
+                        help='directory to cache the teacher features, computed once if missing. '
+                             'Takes a lot of disk, e.g. about 160 GB for the tweet_eval train split with '
+                             'AttnMiniLM and ValMiniLM, a 12-head teacher, a 6-layer student and max_length 128')
+    parser.add_argument("--plot_attention", action='store_true',
+                        help='plot the last attention matrices to wandb during validation')
+    parser.add_argument("--plot_every", default=5, type=int,
+                        help='plot the attention matrices every n epochs')
+    parser.add_argument("--distill_mode", default=None, type=str, choices=['inter', 'pred', 'both'],
+                        help="layers to distill, defaults to the distiller's own mode")
+    parser.add_argument("--grad_checkpointing", action='store_true',
+                        help='recompute student activations in backward, pair with a larger batch_size')
+    parser.add_argument("--compile_model", action='store_true',
+                        help='compile the teacher and student with torch.compile, requires PyTorch 2')
 
     # Optimizer configs
     parser.add_argument("--learning_rate", default=1e-4, type=float)
     parser.add_argument("--weight_decay", default=5e-5, type=float)
     parser.add_argument("--eps", default=1e-8, type=float)
+    parser.add_argument("--optimizer", default='adamw', type=str,
+                        choices=['adamw', 'adamw_fused', 'adamw8bit'],
+                        help='adamw_fused requires PyTorch 2, adamw8bit requires bitsandbytes')
+
+    # Trainer configs
+    parser.add_argument("--devices", default=-1, type=int,
+                        help='number of gpus to distill on, -1 for all')
+    parser.add_argument("--precision", default=32, type=lambda x: int(x) if x.isdigit() else x,
+                        help='training precision, e.g. 32, 16 or bf16, bf16 requires torch>=1.10')
 
     config = yaml.load(open(yaml_path), Loader=yaml.FullLoader)
     args = parser.parse_args(serialize_config(config))
@@ -96,6 +134,9 @@ def get_finetune_args(yaml_path):
     parser.add_argument("--learning_rate", default=1e-4, type=float)
     parser.add_argument("--weight_decay", default=5e-5, type=float)
     parser.add_argument("--eps", default=1e-8, type=float)
+    parser.add_argument("--optimizer", default='adamw', type=str,
+                        choices=['adamw', 'adamw_fused', 'adamw8bit'],
+                        help='adamw_fused requires PyTorch 2, adamw8bit requires bitsandbytes')
 
     config = yaml.load(open(yaml_path), Loader=yaml.FullLoader)
     args = parser.parse_args(serialize_config(config))